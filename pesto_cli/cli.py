@@ -1,11 +1,22 @@
 import collections.abc
+import concurrent.futures
+import contextlib
+import decimal
+import functools
+import itertools
 import json
+import operator
 import os
 import re
+import sys
+import types
 
 import click
+import ijson
 import jinja2
+import orjson
 import requests
+import simdjson
 
 access_key_option = click.option(
     "--access-key",
@@ -40,122 +51,303 @@ def cli():
 def download(database, parse_content, server_url, access_key):
     "Download a full dump of given database in JSON format."
     url = f"{server_url}sync/db/{database}/documents"
-    response = requests.get(url, headers={"Authorization": f"Bearer {access_key}"})
-    response.raise_for_status()
+    with requests.get(
+        url, headers={"Authorization": f"Bearer {access_key}"}, stream=True
+    ) as response:
+        response.raise_for_status()
+        # let urllib3 undo any gzip/deflate encoding while ijson reads the body
+        response.raw.decode_content = True
 
-    data = response.json()
-    if parse_content:
-        new_data = []
-        for document in data:
-            document.update(json.loads(document["content"]))
-            del document["content"]
-            new_data.append(document)
-        data = new_data
-    click.echo(json.dumps(data, indent=2))
-    click.echo(f"{len(data)} documents found", err=True)
+        # documents are decoded as chunks arrive, 1 MiB at a time rather than
+        # ijson's default of 64 KiB
+        documents = ijson.items(response.raw, "item", buf_size=1 << 20)
+        if parse_content:
+            documents = (parse_document_content(d) for d in documents)
+        count = write_json_array(documents)
+    click.echo(f"{count} documents found", err=True)
 
 
-def recursive_get(d, path, separator="."):
-    keys = path.split(separator)
-    v = d
-    for key in keys:
-        v = v[key]
-    return v
+def parse_document_content(document):
+    document.update(loads_exact(document.pop("content")))
+    return document
+
+
+# integers orjson cannot hold in 64 bits have at least 19 digits
+LONG_NUMBER_RE = re.compile(r"\d{19}")
+LONG_NUMBER_BYTES_RE = re.compile(rb"\d{19}")
+
+
+def loads_exact(data):
+    """
+    Decode JSON ``data`` with orjson, unless it may hold numbers orjson
+    would turn into floats or reject, in which case the json module decodes
+    it, keeping non-integer numbers as Decimal like ijson does.
+    """
+    long_number_re = LONG_NUMBER_BYTES_RE if isinstance(data, bytes) else LONG_NUMBER_RE
+    if not long_number_re.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # numbers out of a float's range, such as 1e400, or invalid JSON
+            pass
+    return json.loads(data, parse_float=decimal.Decimal)
+
+
+def write_json_array(documents):
+    """
+    Write documents to stdout as a JSON array, one document at a time,
+    and return the number of documents written.
+    """
+    stdout = click.get_binary_stream("stdout")
+    count = 0
+    separator = b"[\n"
+    for document in documents:
+        stdout.write(separator)
+        stdout.write(dump_document(document))
+        separator = b",\n"
+        count += 1
+    stdout.write(b"\n]\n" if count else b"[]\n")
+    return count
+
+
+def dump_document(document):
+    try:
+        return orjson.dumps(document, default=json_default, option=orjson.OPT_INDENT_2)
+    except orjson.JSONEncodeError:
+        # orjson refuses integers wider than 64 bits, which JSON allows
+        return orjson.dumps(
+            wrap_big_integers(document),
+            default=json_default,
+            option=orjson.OPT_INDENT_2,
+        )
+
+
+def json_default(obj):
+    # lets orjson serialize the Decimal numbers yielded by ijson and the lazy
+    # objects returned by simdjson
+    if isinstance(obj, decimal.Decimal):
+        return orjson.Fragment(str(obj).encode())
+    if isinstance(obj, simdjson.Object):
+        return obj.as_dict()
+    if isinstance(obj, simdjson.Array):
+        return obj.as_list()
+    raise TypeError
+
+
+def wrap_big_integers(obj):
+    if isinstance(obj, dict):
+        return {key: wrap_big_integers(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [wrap_big_integers(value) for value in obj]
+    if isinstance(obj, int) and not -(2**63) <= obj < 2**64:
+        return orjson.Fragment(str(obj).encode())
+    return obj
+
+
+def parse_lazily(data):
+    # a simdjson parser cannot be reused while objects from its previous
+    # document are alive, so each document gets its own
+    try:
+        return simdjson.Parser().parse(data)
+    except (RuntimeError, ValueError):
+        # simdjson rejects integers wider than 64 bits and numbers out of a
+        # float's range, which JSON allows
+        return loads_exact(data)
+
+
+def iter_documents(input, parse=loads_exact):
+    """
+    Yield the documents of a dump without reading it whole. The dump is
+    either a JSON array of documents or newline-delimited JSON, one document
+    per line, in which case each line is decoded with ``parse``.
+    """
+    if input.peek(1).lstrip()[:1] == b"[":
+        yield from ijson.items(input, "item")
+    else:
+        for line in input:
+            if line.strip():
+                yield parse(line)
+
+
+def make_getter(path, separator="."):
+    """
+    Return a function fetching the value at ``path`` in a document, the
+    path being split once instead of on every call.
+    """
+    keys = tuple(sys.intern(key) for key in path.split(separator))
+    if len(keys) == 1:
+        # the common case, handled entirely in C
+        return operator.itemgetter(keys[0])
+
+    def getter(d):
+        for key in keys:
+            d = d[key]
+        return d
+
+    return getter
+
+
+BOOLEAN_CORRESPONDANCES = types.MappingProxyType(
+    {
+        "true": True,
+        "yes": True,
+        "1": True,
+        "false": False,
+        "no": False,
+        "0": False,
+    }
+)
 
 
 def autocast(v1, v2):
+    if v2 is None:
+        # "exists" lookups have no value to cast
+        return v2
     if isinstance(v1, str):
         return str(v2)
     if isinstance(v1, list):
         return str(v2)
     if isinstance(v1, bool):
-        correspondances = {
-            "true": True,
-            "yes": True,
-            "1": True,
-            "false": False,
-            "no": False,
-            "0": False,
-        }
-        return correspondances[str(v2).lower()]
+        return BOOLEAN_CORRESPONDANCES[str(v2).lower()]
+    if isinstance(v1, (int, float, decimal.Decimal)):
+        # integers and the Decimal numbers yielded by ijson are compared
+        # exactly, other numbers as floats; a lookup value that is not a
+        # number is left as is, and never equals v1
+        if isinstance(v1, int):
+            try:
+                return int(v2)
+            except ValueError:
+                pass
+        elif isinstance(v1, decimal.Decimal):
+            try:
+                return decimal.Decimal(v2)
+            except decimal.InvalidOperation:
+                pass
+        try:
+            return float(v2)
+        except ValueError:
+            return v2
 
     return v2
 
 
-def match_lookup(value, lookup, lookup_value):
-    lookup_value = autocast(value, lookup_value)
-
-    if lookup == "iexact":
-        return lookup_value.lower() == value.lower()
-    if lookup == "exact":
-        return lookup_value == value
-    if lookup == "ne":
-        return lookup_value != value
-    if lookup == "gt":
-        import pdb
-
-        pdb.set_trace()
-
-        return value > lookup_value
-    if lookup == "gte":
-        return value >= lookup_value
-    if lookup == "lt":
-        return value < lookup_value
-    if lookup == "lte":
-        return value <= lookup_value
-    if lookup == "in":
-        return lookup_value in value
-    if lookup == "exists":
-        return True
+def make_caster(lookup_value):
+    """
+    Return a function casting ``lookup_value`` like ``autocast`` does for a
+    given document value. The result only depends on the type of that value,
+    so it is computed once per type instead of once per document.
+    """
+    casts = {}
+
+    def cast(value):
+        value_type = type(value)
+        if value_type not in casts:
+            casts[value_type] = autocast(value, lookup_value)
+        return casts[value_type]
+
+    return cast
 
+
+# lookup name -> function(value, lookup_value)
+LOOKUPS = {
+    "iexact": lambda value, lookup_value: lookup_value.lower() == value.lower(),
+    "exact": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "in": operator.contains,
+    "exists": lambda value, lookup_value: True,
+}
+
+
+FILTER_RE = re.compile(
+    r"^(?P<key>[^<>=!]+)(?:(?P<operator>>=|<=|!=|<|>|=)(?P<value>.*))?$"
+)
+FILTER_OPERATORS = {
+    ">=": "gte",
+    "<=": "lte",
+    "!=": "ne",
+    "<": "lt",
+    ">": "gt",
+    "=": "exact",
+    None: "exists",
+}
+
+
+def never(value, lookup_value):
     return False
 
 
-def match(document, f):
+# rough relative cost of each lookup, used to run the cheapest filters first
+LOOKUP_COSTS = {"exists": 0, "exact": 1, "ne": 1, "iexact": 2, "in": 3}
+
+
+def compile_filter(f):
+    """
+    Parse a filter such as ``created_at>=2021-01-12`` once, returning a
+    ``(getter, lookup, cast, cost)`` tuple: the first three are the
+    arguments of ``match_compiled``, ``cost`` a rough estimate of how
+    expensive the filter is to evaluate.
+    """
+    m = FILTER_RE.match(f)
+    if m is None:
+        raise click.BadParameter(f"invalid filter {f!r}")
+    key, op, lookup_value = m.group("key", "operator", "value")
+    # without an operator we check only for the presence of a non empty field
+    lookup = FILTER_OPERATORS[op]
+    if "__" in key:
+        key, lookup = key.split("__")
+        if op is None and lookup != "exists":
+            raise click.BadParameter(f"{lookup!r} lookup needs a value in {f!r}")
+    return (
+        make_getter(key),
+        # unknown lookups match nothing
+        LOOKUPS.get(lookup, never),
+        make_caster(lookup_value),
+        LOOKUP_COSTS.get(lookup, 1),
+    )
+
+
+def match_compiled(document, getter, lookup, cast):
     try:
-        if ">=" in f:
-            key, lookup_value = f.split(">=")
-            lookup = "gte"
-        elif "!=" in f:
-            key, lookup_value = f.split("!=")
-            lookup = "ne"
-        elif "<=" in f:
-            key, lookup_value = f.split("<=")
-            lookup = "lte"
-        elif "<" in f:
-            key, lookup_value = f.split("<")
-            lookup = "lt"
-        elif ">" in f:
-            key, lookup_value = f.split(">")
-            lookup = "gt"
-        elif "=" in f:
-            key, lookup_value = f.split("=")
-            lookup = "exact"
-        else:
-            # we check only for the presence of a non empty field
-            key = f
-            lookup = "exists"
-            lookup_value = None
-        if "__" in key:
-            key, lookup = key.split("__")
-        value = recursive_get(document, key)
-        if match_lookup(value, lookup, lookup_value):
-            return True
+        value = getter(document)
+        return lookup(value, cast(value))
     except KeyError:
         return False
 
 
+def filter_cost(compiled_filter):
+    return compiled_filter[-1]
+
+
 def keep_document(document, filter, exclude):
+    """
+    ``filter`` and ``exclude`` are lists of ``(getter, lookup, cast)``
+    tuples, as returned by ``compile_filter`` without the cost. The shorter
+    list is checked first, so that most documents are rejected with as few
+    lookups as possible.
+    """
+    matches = match_compiled
+    if len(exclude) < len(filter):
+        return not any(matches(document, *f) for f in exclude) and all(
+            matches(document, *f) for f in filter
+        )
+    return all(matches(document, *f) for f in filter) and not any(
+        matches(document, *f) for f in exclude
+    )
 
-    if filter and not all((match(document, f) for f in filter)):
-        return False
-    if exclude and any((match(document, f) for f in exclude)):
-        return False
-    return True
+
+def compile_filters(filters):
+    """
+    Compile ``filters``, cheapest first, for use with ``keep_document``.
+    """
+    return [f[:-1] for f in sorted(map(compile_filter, filters), key=filter_cost)]
 
 
 @cli.command("filter")
-@click.argument("input", type=click.File("r"))
+@click.argument("input", type=click.File("rb"))
 @click.option(
     "-f", "--filter", help="Filter entries using the given field/value", multiple=True
 )
@@ -169,48 +361,175 @@ def filter_(input, filter, exclude):
     """
     Filter/exclude documents from a database dump, outputting the result.
     """
-    documents = json.loads(input.read())
-    new_documents = [d for d in documents if keep_document(d, filter, exclude)]
-
-    click.echo(json.dumps(new_documents, indent=2))
-    click.echo(f"{len(new_documents)} matching documents", err=True)
+    filter = compile_filters(filter)
+    exclude = compile_filters(exclude)
+    # simdjson parses lines lazily: only the fields the filters look at, and
+    # the documents we keep, are turned into Python objects
+    documents = iter_documents(input, parse=parse_lazily)
+    count = write_json_array(d for d in documents if keep_document(d, filter, exclude))
+    click.echo(f"{count} matching documents", err=True)
 
 
 TAG_REGEX = r'((#|\+{1,5}|-{1,5}|~|\?|!|@)([:A-zÀ-ÿ\d][:A-zÀ-ÿ\d-]*(=(true|false|[:A-zÀ-ÿ\d-]+|"[^"]*")?(-?\d*(\.(\d+))?)?)?))'
+TAG_RE = re.compile(TAG_REGEX)
+
+
+FLATTEN_TABLE = str.maketrans(dict.fromkeys(":.- ", "_"))
 
 
 def flatten(d, parent_key="", sep="_", replace=":.- "):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.abc.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
+    # walk nested mappings with an explicit stack of iterators, which keeps
+    # the original key order without recursing, and clean keys in one pass
+    if sep == "_" and replace == ":.- ":
+        table = FLATTEN_TABLE
+    else:
+        table = str.maketrans(dict.fromkeys(replace, sep))
+    items = {}
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        prefix, children = stack[-1]
+        for k, v in children:
+            new_key = prefix + sep + k if prefix else k
+            if isinstance(v, collections.abc.MutableMapping):
+                stack.append((new_key, iter(v.items())))
+                break
+            items[new_key.translate(table)] = v
         else:
-            for char in replace:
-                new_key = new_key.replace(char, sep)
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return items
+
+
+def _strip_annotation(match):
+    return "" if match[2] == "@" else match[0]
 
 
 def remove_annotations(text):
-    matches = re.findall(TAG_REGEX, text)
-    for match in matches:
-        if match[0].startswith("@"):
-            text = text.replace(match[0], "")
-    return text
+    return TAG_RE.sub(_strip_annotation, text)
 
 
 def write_file(filename, content, output_dir, replace=False):
+    """
+    Write ``content`` bytes to ``filename`` in ``output_dir``. Unless
+    ``replace`` is set, the file is created atomically with O_EXCL, so an
+    existing file is never overwritten.
+    """
     path = os.path.join(output_dir, filename)
-    if os.path.exists(path) and not replace:
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if not replace:
+        flags |= os.O_EXCL
+    try:
+        fd = os.open(path, flags, 0o666)
+    except FileExistsError:
         raise ValueError("{} already exists".format(path))
 
-    with open(path, "w") as f:
-        f.write(content)
+    try:
+        content = memoryview(content)
+        while content:
+            content = content[os.write(fd, content) :]
+    finally:
+        os.close(fd)
+
+
+def parse_option(option):
+    """
+    Split a ``key=value`` option, decoding the value as JSON when possible.
+    """
+    key, value = option.split("=")
+    try:
+        return key, orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return key, value
+
+
+MARKDOWN_TEMPLATE = """{% if front_matter %}---
+{{front_matter|tojson(indent=2)}}
+---{% endif %}{% if not front_matter %}# {{ title }}
+
+{% endif %}
+{{ fragments_text_content }}"""
+
+
+@functools.lru_cache()
+def compile_template(source):
+    # cached so that each worker process compiles the template only once
+    env = jinja2.Environment(loader=jinja2.BaseLoader)
+    # numbers read by ijson are Decimal, which json.dumps cannot serialize
+    env.policies["json.dumps_kwargs"] = {"sort_keys": True, "default": float}
+    return env.from_string(source)
+
+
+def render_document(
+    document,
+    file_name,
+    annotations,
+    aliases,
+    defaults,
+    overrides,
+    front_matter_fields,
+):
+    """
+    Render a single document as markdown, returning the name of its file
+    and its UTF-8 encoded body. ``defaults`` and ``overrides`` are dicts,
+    ``aliases`` a list of ``(key, source_key)`` pairs.
+    """
+    fields = flatten(document)
+    for key, value in aliases:
+        if value in fields:
+            fields[key] = fields[value]
+    # layered lookup instead of copying defaults and overrides in the fields
+    context = collections.ChainMap({}, overrides, fields, defaults)
+    if front_matter_fields:
+        context["front_matter"] = {
+            field: context[field] for field in front_matter_fields if field in context
+        }
+
+    body = compile_template(MARKDOWN_TEMPLATE).render(context)
+    if not annotations:
+        body = remove_annotations(body)
+
+    try:
+        filename = file_name.format_map(context)
+    except KeyError as e:
+        raise click.ClickException(f"no {e} field to build {file_name!r} from")
+    return filename, body.encode("utf-8")
+
+
+def render_batch(render, documents):
+    return [render(document) for document in documents]
+
+
+def render_documents(render, documents, jobs):
+    """
+    Yield the result of ``render`` for each document, in order, spreading
+    the work over ``jobs`` processes.
+    """
+    if jobs == 1:
+        # no need to start a worker and pickle every document
+        yield from map(render, documents)
+        return
+
+    jobs = jobs or os.cpu_count() or 1
+    batches = iter(lambda: list(itertools.islice(documents, 32)), [])
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for batch in batches:
+                pending.append(executor.submit(render_batch, render, batch))
+                # only a few batches per worker are read ahead, so memory stays
+                # flat however large the dump is
+                if len(pending) >= 2 * jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        except BaseException:
+            # don't render documents that will never be written
+            for future in pending:
+                future.cancel()
+            raise
 
 
 @cli.command("build-markdown")
-@click.argument("input", type=click.File("r"))
+@click.argument("input", type=click.File("rb"))
 @click.argument(
     "output_dir", type=click.Path(dir_okay=True, file_okay=False, exists=True)
 )
@@ -233,6 +552,13 @@ def write_file(filename, content, output_dir, replace=False):
 @click.option(
     "--overrides", "-o", type=str, default=[], multiple=True, help="category=Posts"
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes, defaults to the number of CPUs.",
+)
 def build_markdown(
     input,
     output_dir,
@@ -244,60 +570,43 @@ def build_markdown(
     aliases,
     overrides,
     front_matter_fields,
+    jobs,
 ):
     """
     Build markdown posts from a database dump
     """
-    documents = json.loads(input.read())
-
-    click.echo(f"Building {len(documents)} documents", err=True)
-    for document in documents:
-
-        context = {key: value for key, value in flatten(document).items()}
-        for alias in aliases:
-            key, value = alias.split("=")
-            if value in context:
-                context[key] = context[value]
-        for default in defaults:
-            key, value = default.split("=")
-
-            try:
-                v = json.loads(value)
-            except json.decoder.JSONDecodeError:
-                v = value
-            context.setdefault(key, v)
-        for override in overrides:
-            key, value = override.split("=")
-            try:
-                v = json.loads(value)
-            except json.decoder.JSONDecodeError:
-                v = value
-            context[key] = v
-        if front_matter_fields:
-            context["front_matter"] = {}
-            for field in front_matter_fields.split(","):
-                field = field.strip()
-                if field in context:
-                    context["front_matter"][field] = context[field]
-
-        template ="""{% if front_matter %}---
-{{front_matter|tojson(indent=2)}}
----{% endif %}{% if not front_matter %}# {{ title }}
-
-{% endif %}
-{{ fragments_text_content }}"""
-        j2_template = jinja2.Environment(loader=jinja2.BaseLoader).from_string(
-            template
-        )
-
-        body = j2_template.render(**context)
-        if not annotations:
-            body = remove_annotations(body)
-
-        filename = file_name.format(**context)
-        click.echo(f"Writing {filename}…", err=True)
-        if not dry_run:
-            write_file(filename, body, output_dir, replace=force)
+    documents = iter_documents(input)
+
+    aliases = [alias.split("=") for alias in aliases]
+    # the first default given for a key wins, the last override does
+    defaults = dict(reversed([parse_option(default) for default in defaults]))
+    overrides = dict(parse_option(override) for override in overrides)
+    if front_matter_fields:
+        front_matter_fields = [f.strip() for f in front_matter_fields.split(",")]
+    render = functools.partial(
+        render_document,
+        file_name=file_name,
+        annotations=annotations,
+        aliases=aliases,
+        defaults=defaults,
+        overrides=overrides,
+        front_matter_fields=front_matter_fields,
+    )
+
+    count = 0
+    # documents are independent, so rendering is spread over several
+    # processes; files are still written here, in input order, so that the
+    # last document wins and the build stops at the first failure
+    with contextlib.closing(render_documents(render, documents, jobs)) as rendered:
+        for filename, body in rendered:
+            click.echo(f"Writing {filename}…", err=True)
+            if not dry_run:
+                try:
+                    write_file(filename, body, output_dir, replace=force)
+                except ValueError as e:
+                    raise click.ClickException(str(e))
+            count += 1
+    click.echo(f"{count} documents built", err=True)
 
 
 if __name__ == "__main__":
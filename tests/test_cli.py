@@ -0,0 +1,247 @@
+import io
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from pesto_cli import cli
+
+BIG = 123456789012345678901234567890
+
+DOCUMENTS = [
+    {"id": "1", "type": "note", "title": "a>b", "nsites": 3, "pinned": True},
+    {"id": "2", "type": "setting", "title": "b", "nsites": 7, "pinned": False},
+    {"id": "3", "type": "note", "title": "c", "tags": ["sleep"]},
+]
+
+
+@pytest.fixture
+def runner():
+    return CliRunner(mix_stderr=False)
+
+
+@pytest.fixture
+def dump(tmp_path):
+    def write(documents, ndjson=False, name="data.json"):
+        path = tmp_path / name
+        if ndjson:
+            path.write_text("".join(json.dumps(d) + "\n" for d in documents))
+        else:
+            path.write_text(json.dumps(documents))
+        return str(path)
+
+    return write
+
+
+def run_filter(runner, path, *filters):
+    args = ["filter", path]
+    for f in filters:
+        args += ["-f", f]
+    return runner.invoke(cli.cli, args)
+
+
+def ids(result):
+    assert result.exit_code == 0, result.stderr
+    return [d["id"] for d in json.loads(result.stdout)]
+
+
+@pytest.mark.parametrize(
+    "f, expected",
+    [
+        ("type=note", ["1", "3"]),
+        ("type!=note", ["2"]),
+        ("type__iexact=NOTE", ["1", "3"]),
+        ("tags__in=sleep", ["3"]),
+        ("tags", ["3"]),
+        # values may contain operator characters
+        ("title=a>b", ["1"]),
+        # numbers are compared as numbers
+        ("nsites=3", ["1"]),
+        ("nsites>=3", ["1", "2"]),
+        ("nsites<7", ["1"]),
+        # a lookup value that is not a number never equals a number
+        ("nsites!=foo", ["1", "2"]),
+        ("nsites=foo", []),
+        # boolean fields
+        ("pinned", ["1", "2"]),
+        ("pinned=yes", ["1"]),
+        ("type__unknown=note", []),
+    ],
+)
+@pytest.mark.parametrize("ndjson", [False, True])
+def test_filter(runner, dump, f, expected, ndjson):
+    result = run_filter(runner, dump(DOCUMENTS, ndjson=ndjson), f)
+    assert ids(result) == expected
+    assert result.stderr == f"{len(expected)} matching documents\n"
+
+
+def test_filter_exclude(runner, dump):
+    result = runner.invoke(
+        cli.cli, ["filter", dump(DOCUMENTS), "-f", "type=note", "-e", "tags"]
+    )
+    assert ids(result) == ["1"]
+
+
+@pytest.mark.parametrize("f", ["foo!", "title__iexact"])
+def test_filter_invalid(runner, dump, f):
+    result = run_filter(runner, dump(DOCUMENTS), f)
+    assert result.exit_code == 2
+    assert "Traceback" not in result.stderr
+
+
+def test_filter_output(runner, dump):
+    result = run_filter(runner, dump(DOCUMENTS), "id=2")
+    assert result.stdout == "[\n" + json.dumps(DOCUMENTS[1], indent=2) + "\n]\n"
+
+    result = run_filter(runner, dump(DOCUMENTS), "id=4")
+    assert result.stdout == "[]\n"
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+def test_filter_keeps_exact_numbers(runner, dump, ndjson):
+    documents = [
+        {"id": "1", "n": BIG, "f": 0.1},
+        {"id": "2", "n": 9007199254740993, "f": 2.5},
+    ]
+    path = dump(documents, ndjson=ndjson)
+
+    assert ids(run_filter(runner, path, f"n={BIG}")) == ["1"]
+    assert ids(run_filter(runner, path, "n=9007199254740993")) == ["2"]
+    assert ids(run_filter(runner, path, "f=0.1")) == ["1"]
+    result = run_filter(runner, path)
+    assert json.loads(result.stdout) == documents
+
+
+def build(runner, path, output_dir, *args):
+    return runner.invoke(
+        cli.cli,
+        ["build-markdown", path, str(output_dir), *args],
+        catch_exceptions=False,
+    )
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_build_markdown(runner, dump, tmp_path, jobs):
+    documents = [
+        {
+            "created_at": f"2021-01-0{i}",
+            "title": f"Post {i}",
+            "fragments": {"text": {"content": f"hello @private #{i}"}},
+        }
+        for i in range(1, 4)
+    ]
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    result = build(runner, dump(documents), output_dir, "-j", jobs)
+
+    assert result.exit_code == 0, result.stderr
+    assert result.stderr.splitlines()[-1] == "3 documents built"
+    assert sorted(p.name for p in output_dir.iterdir()) == [
+        "2021-01-01.md",
+        "2021-01-02.md",
+        "2021-01-03.md",
+    ]
+    assert (output_dir / "2021-01-02.md").read_text() == "# Post 2\n\n\nhello  #2"
+
+
+def test_build_markdown_front_matter(runner, dump, tmp_path):
+    documents = [{"created_at": "x", "n": BIG, "f": 1.5, "title": "T"}]
+    result = build(
+        runner,
+        dump(documents, ndjson=True),
+        tmp_path,
+        "--front-matter-fields",
+        "title,n,f,layout,category",
+        "-d",
+        "layout=post",
+        "-o",
+        "category=Posts",
+        "-o",
+        "title=Overridden",
+    )
+
+    assert result.exit_code == 0, result.stderr
+    front_matter = (tmp_path / "x.md").read_text().split("---")[1]
+    assert json.loads(front_matter) == {
+        "title": "Overridden",
+        "n": BIG,
+        "f": 1.5,
+        "layout": "post",
+        "category": "Posts",
+    }
+
+
+def test_build_markdown_last_document_wins(runner, dump, tmp_path):
+    documents = [{"created_at": "same", "title": f"doc {i}"} for i in range(200)]
+
+    result = build(runner, dump(documents), tmp_path, "--force", "-j", "4")
+
+    assert result.exit_code == 0, result.stderr
+    assert (tmp_path / "same.md").read_text().startswith("# doc 199\n")
+
+
+def test_build_markdown_stops_at_existing_file(runner, dump, tmp_path):
+    documents = [{"created_at": f"d{i}", "title": "t"} for i in range(200)]
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    (output_dir / "d10.md").write_text("")
+
+    result = build(runner, dump(documents), output_dir, "-j", "4")
+
+    assert result.exit_code == 1
+    assert result.stderr.endswith(f"Error: {output_dir / 'd10.md'} already exists\n")
+    assert len(list(output_dir.iterdir())) == 11
+
+
+def test_build_markdown_missing_file_name_field(runner, dump, tmp_path):
+    result = build(runner, dump([{"title": "t"}]), tmp_path, "-j", "1")
+
+    assert result.exit_code == 1
+    assert "no 'created_at' field" in result.stderr
+
+
+class FakeResponse:
+    def __init__(self, documents):
+        self.raw = io.BytesIO(json.dumps(documents).encode())
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_download(runner, monkeypatch):
+    content = '{"type": "note", "big": %d, "huge": 1e400, "f": 0.1}' % BIG
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append((url, kwargs))
+        return FakeResponse([{"id": "1", "content": content}])
+
+    monkeypatch.setattr(cli.requests, "get", get)
+
+    result = runner.invoke(
+        cli.cli,
+        ["download", "DEFAULT", "--access-key", "key", "-s", "http://pesto/"],
+    )
+
+    assert result.exit_code == 0, result.stderr
+    assert calls[0][0] == "http://pesto/sync/db/DEFAULT/documents"
+    assert calls[0][1]["headers"] == {"Authorization": "Bearer key"}
+    assert result.stdout == (
+        "[\n"
+        "{\n"
+        '  "id": "1",\n'
+        '  "type": "note",\n'
+        f'  "big": {BIG},\n'
+        '  "huge": 1E+400,\n'
+        '  "f": 0.1\n'
+        "}\n"
+        "]\n"
+    )
+    assert result.stderr == "1 documents found\n"